@@ -4,80 +4,105 @@
 # License: GPL3
 #   See the "LICENSE" file for full details
 
-"""List all AWS resources created by any CloudFormation stack in any region."""
+"""List all AWS resources created by any CloudFormation stack in any region.
+
+By default only stacks in a steady (*_COMPLETE) state are listed; Use --status to select others.
+"""
 
-import sys
-import csv
 import argparse
-import boto3
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import helpers
 
+# Stack statuses which may be selected with --status
+STACK_STATUSES = ('CREATE_IN_PROGRESS',
+                  'CREATE_FAILED',
+                  'CREATE_COMPLETE',
+                  'ROLLBACK_IN_PROGRESS',
+                  'ROLLBACK_FAILED',
+                  'ROLLBACK_COMPLETE',
+                  #'DELETE_IN_PROGRESS',
+                  'DELETE_FAILED',
+                  #'DELETE_COMPLETE',
+                  'UPDATE_IN_PROGRESS',
+                  'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS',
+                  'UPDATE_COMPLETE',
+                  'UPDATE_ROLLBACK_IN_PROGRESS',
+                  'UPDATE_ROLLBACK_FAILED',
+                  'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
+                  'UPDATE_ROLLBACK_COMPLETE',
+                  'REVIEW_IN_PROGRESS')
+
+# Default stack statuses; These cover stacks in a steady state
+DEFAULT_STACK_STATUSES = ('CREATE_COMPLETE',
+                          'UPDATE_COMPLETE',
+                          'UPDATE_ROLLBACK_COMPLETE',
+                          'ROLLBACK_COMPLETE')
+
+# Number of stacks per region to fetch resources for concurrently
+# Workers share one client, so keep this within helpers.CLIENT_CONFIG max_pool_connections
+STACK_WORKERS = 16
+
 def main():
     """Gather and write CSV data, one row per Resource.
 
-    Iterate through specified AWS regions
+    Iterate through specified AWS regions (concurrently)
     Iterate through all CloudFormation stacks
     Iterate through all resources
     Query basic stack and resource information
     """
     args = parse_args()
-    if args.region == 'all' or args.region == 'ALL':
-        region_list = list(helpers.get_region_list())
-    else:
-        # Check valid or return default region
-        region_list = [helpers.get_region(args.region)]
 
-    output = csv.writer(sys.stdout, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+    # Header row
+    header = ['Account', 'Region', 'StackName', 'LogicalResourceId', 'ResourceType',
+              'PhysicalResourceId', 'StackID', 'StackStatus']
+    helpers.run_report(args, header, collect_region, args.status)
 
-    # Get AWS account number from STS
-    account_number = boto3.client('sts').get_caller_identity()['Account']
+def collect_region(region, account_number, stack_statuses):
+    """Return list of CSV rows, one per Resource in stacks with stack_statuses in region."""
+    cfn_client = helpers.make_client('cloudformation', region)
+    # Stacks in REVIEW_IN_PROGRESS have a change set but no resources, so skip querying them
+    stacks = [stack for stack in helpers.get_items(client=cfn_client,
+                                                   function='list_stacks',
+                                                   item_name='StackSummaries',
+                                                   StackStatusFilter=list(stack_statuses))
+              if stack['StackStatus'] != 'REVIEW_IN_PROGRESS']
 
-    # Header row
-    output.writerow(['Account', 'Region', 'StackName', 'LogicalResourceId', 'ResourceType',
-                     'PhysicalResourceId', 'StackID', 'StackStatus'])
+    # Fetch resources of several stacks concurrently, rather than one stack at a time
+    # Workers share the region's client, which is thread-safe
+    # map() yields each stack's resources in stack order as they become available
+    rows = []
+    with ThreadPoolExecutor(max_workers=STACK_WORKERS) as executor:
+        stack_resources = executor.map(functools.partial(get_stack_resources, cfn_client),
+                                       [stack['StackId'] for stack in stacks])
+        for stack, resources in zip(stacks, stack_resources):
+            for resource in resources:
+                rows.append((account_number,
+                             region,
+                             stack['StackName'],
+                             resource['LogicalResourceId'],
+                             resource['ResourceType'],
+                             # If a logical resource has no PhysicalResourceId (i.e. ARN), then
+                             # the corresponding physical resource does not exist and has been
+                             # deleted outside of CloudFormation
+                             resource.get('PhysicalResourceId', "[Deleted]"),
+                             stack['StackId'],
+                             stack['StackStatus']))
+    return rows
 
-    for region in region_list:
-        cfn_client = boto3.client('cloudformation', region_name=region)
-        stack_status_filter = ['CREATE_IN_PROGRESS',
-                               'CREATE_FAILED',
-                               'CREATE_COMPLETE',
-                               'ROLLBACK_IN_PROGRESS',
-                               'ROLLBACK_FAILED',
-                               'ROLLBACK_COMPLETE',
-                               #'DELETE_IN_PROGRESS',
-                               'DELETE_FAILED',
-                               #'DELETE_COMPLETE',
-                               'UPDATE_IN_PROGRESS',
-                               'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS',
-                               'UPDATE_COMPLETE',
-                               'UPDATE_ROLLBACK_IN_PROGRESS',
-                               'UPDATE_ROLLBACK_FAILED',
-                               'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
-                               'UPDATE_ROLLBACK_COMPLETE',
-                               'REVIEW_IN_PROGRESS']
-        for stack in helpers.get_items(client=cfn_client,
-                                       function='list_stacks',
-                                       item_name='StackSummaries',
-                                       StackStatusFilter=stack_status_filter):
-            for resource in helpers.get_items(client=cfn_client,
-                                              function='list_stack_resources',
-                                              item_name='StackResourceSummaries',
-                                              StackName=stack['StackId']):
-                try:
-                    physical_resource_id = resource['PhysicalResourceId']
-                except KeyError:
-                    # If a logical resource has no PhysicalResourceId (i.e. ARN), then the
-                    # corresponding physical resource does not exist and has been deleted outside
-                    # of CloudFormation
-                    physical_resource_id = "[Deleted]"
-                output.writerow([account_number,
-                                 region,
-                                 stack['StackName'],
-                                 resource['LogicalResourceId'],
-                                 resource['ResourceType'],
-                                 physical_resource_id,
-                                 stack['StackId'],
-                                 stack['StackStatus']])
+def get_stack_resources(cfn_client, stack_id):
+    """Return list of resources in CloudFormation stack."""
+    try:
+        return list(helpers.get_items(client=cfn_client,
+                                      function='list_stack_resources',
+                                      item_name='StackResourceSummaries',
+                                      StackName=stack_id))
+    except cfn_client.exceptions.ClientError as err:
+        if not helpers.is_throttled(err):
+            raise
+        # Still throttled after retries; Skip this stack rather than abandoning the region
+        helpers.report_skipped(f'Skipping stack {stack_id}: {err}')
+        return []
 
 def parse_args():
     """Create arguments and populate variables from args.
@@ -86,6 +111,12 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--region', type=str, default=False,
                         help='AWS region; Use "all" for all regions')
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help='Compress output with gzip')
+    parser.add_argument('-s', '--status', nargs='+', choices=STACK_STATUSES,
+                        default=DEFAULT_STACK_STATUSES, metavar='STATUS',
+                        help='Stack status(es) to include (default: {0})'.format(
+                            ' '.join(DEFAULT_STACK_STATUSES)))
     return parser.parse_args()
 
 if __name__ == '__main__':
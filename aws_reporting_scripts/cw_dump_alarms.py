@@ -13,16 +13,22 @@
   - If Action is an SNS topic, proto and endpoints/subscribers
 """
 
-import sys
 import argparse
-import csv
-import boto3
 import helpers
 
+# Pretty/abbreviated versions of statistics and operators
+PRETTY_STATISTICS = {"Average": "avg",
+                     "Maximum": "max",
+                     "Minimum": "min"}
+PRETTY_OPERATORS = {"GreaterThanOrEqualToThreshold": ">=",
+                    "GreaterThanThreshold": ">",
+                    "LessThanOrEqualToThreshold": "<=",
+                    "LessThanThreshold": "<"}
+
 def main():
     """Gather and write CSV data, one row per Alarm.
 
-    Iterate through specified AWS regions
+    Iterate through specified AWS regions (concurrently)
     Iterate through all Alarms
     Query for Alarm details
     Iterate through first two returned Alarm Actions
@@ -31,100 +37,65 @@ def main():
     """
 
     args = parse_args()
-    if args.region == 'all' or args.region == 'ALL':
-        region_list = list(helpers.get_region_list())
-    else:
-        # Check valid or return default region
-        region_list = [helpers.get_region(args.region)]
-
-    output = csv.writer(sys.stdout, delimiter=',', quotechar='"',
-                        quoting=csv.QUOTE_ALL)
 
     # Header row
-    output.writerow(['Account', 'Region',
-                     'Name', 'Description',
-                     'Metric', 'Stat', 'Op', 'Thresh', 'EvalPeriods', 'Period', 'Dimensions',
-                     'Action0', 'Action0 SNS DisplayName', 'Action0 SNS Subscriptions',
-                     'Action1', 'Action1 SNS DisplayName', 'Action1 SNS Subscriptions'])
-
-    # Get AWS account number from STS
-    account_number = boto3.client('sts').get_caller_identity()['Account']
-
-    # Iterate through regions and Alarms
-    for region in region_list:
-        cw_client = boto3.client('cloudwatch', region_name=region)
-        for alarm in helpers.get_items(client=cw_client,
-                                       function='describe_alarms',
-                                       item_name='MetricAlarms'):
-            # Join Name and Value for each dimension with '='
-            # Then join each dimension pair comma-separated
-            dimensions = ','.join(['{}={}'.format(dimension['Name'], dimension['Value'])
-                                   for dimension in alarm['Dimensions']])
-
-            # Try getting first two actions
-            try:
-                action0 = alarm['AlarmActions'][0]
-            except IndexError:
-                action0 = "No action"
-            try:
-                action1 = alarm['AlarmActions'][1]
-            except IndexError:
-                action1 = "No action"
-
-            # Attempt to populate SNS DisplayName and Subscriptions if Actions look like SNS topics
-            action0_sns_displayname, action0_sns_subscriptions = '', ''
-            action1_sns_displayname, action1_sns_subscriptions = '', ''
-            if "arn:aws:sns" in action0 or "arn:aws:sns" in action1:
-                sns_client = boto3.client('sns', region_name=region)
-                # Join proto and endpoint for each subscription ': '
-                # Then join each subscription pair comman-separated
-                if "arn:aws:sns" in action0:
-                    try:
-                        sns_client.get_topic_attributes(TopicArn=action0)
-                    except sns_client.exceptions.NotFoundException:
-                        # Topic does not exist or cannot be listed
-                        break
-                    action0_sns_displayname = get_topic_name(sns_client, action0)
-                    action0_sns_subscriptions = ','.join(
-                        ['{}: {}'.format(subscription['Protocol'],
-                                         subscription['Endpoint'])
-                         for subscription in helpers.get_items(client=sns_client,
-                                                               function='list_subscriptions_by_topic',
-                                                               item_name='Subscriptions',
-                                                               TopicArn=action0)])
-                if "arn:aws:sns" in action1:
-                    try:
-                        sns_client.get_topic_attributes(TopicArn=action1)
-                    except sns_client.exceptions.NotFoundException:
-                        # Topic does not exist or cannot be listed
-                        break
-                    action1_sns_displayname = get_topic_name(sns_client, action1)
-                    action1_sns_subscriptions = ','.join(
-                        ['{}: {}'.format(subscription['Protocol'],
-                                         subscription['Endpoint'])
-                         for subscription in helpers.get_items(client=sns_client,
-                                                               function='list_subscriptions_by_topic',
-                                                               item_name='Subscriptions',
-                                                               TopicArn=action1)])
-
-            # Output data
-            output.writerow([account_number,
-                             region,
-                             alarm['AlarmName'],
-                             alarm.get('AlarmDescription', ''),
-                             alarm['MetricName'],
-                             pretty_statistic(alarm['Statistic']),
-                             pretty_operator(alarm['ComparisonOperator']),
-                             alarm['Threshold'],
-                             alarm['EvaluationPeriods'],
-                             alarm['Period'],
-                             dimensions,
-                             action0,
-                             action0_sns_displayname,
-                             action0_sns_subscriptions,
-                             action1,
-                             action1_sns_displayname,
-                             action1_sns_subscriptions])
+    header = ['Account', 'Region',
+              'Name', 'Description',
+              'Metric', 'Stat', 'Op', 'Thresh', 'EvalPeriods', 'Period', 'Dimensions',
+              'Action0', 'Action0 SNS DisplayName', 'Action0 SNS Subscriptions',
+              'Action1', 'Action1 SNS DisplayName', 'Action1 SNS Subscriptions']
+    helpers.run_report(args, header, collect_region)
+
+def collect_region(region, account_number):
+    """Return list of CSV rows, one per Alarm in region."""
+    cw_client = helpers.make_client('cloudwatch', region)
+    # SNS topic DisplayName and Subscriptions, keyed by topic ARN
+    # Many alarms commonly share the same topics, so query each topic only once
+    topics = {}
+    rows = []
+    for alarm in helpers.get_items(client=cw_client,
+                                   function='describe_alarms',
+                                   item_name='MetricAlarms',
+                                   page_size=100):
+        # Join Name and Value for each dimension with '='
+        # Then join each dimension pair comma-separated
+        dimensions = ','.join(f"{dimension['Name']}={dimension['Value']}"
+                              for dimension in alarm['Dimensions'])
+
+        # Try getting first two actions
+        try:
+            action0 = alarm['AlarmActions'][0]
+        except IndexError:
+            action0 = "No action"
+        try:
+            action1 = alarm['AlarmActions'][1]
+        except IndexError:
+            action1 = "No action"
+
+        # Attempt to populate SNS DisplayName and Subscriptions if Actions look like SNS topics
+        for action in (action0, action1):
+            if "arn:aws:sns" in action and action not in topics:
+                # SNS client is only created once a region has an SNS action to look up
+                sns_client = helpers.make_client('sns', region)
+                topics[action] = get_topic_info(sns_client, action)
+
+        # Output data
+        rows.append((account_number,
+                     region,
+                     alarm['AlarmName'],
+                     alarm.get('AlarmDescription', ''),
+                     alarm['MetricName'],
+                     pretty_statistic(alarm['Statistic']),
+                     pretty_operator(alarm['ComparisonOperator']),
+                     alarm['Threshold'],
+                     alarm['EvaluationPeriods'],
+                     alarm['Period'],
+                     dimensions,
+                     action0,
+                     *topics.get(action0, ('', '')),    # SNS DisplayName, Subscriptions
+                     action1,
+                     *topics.get(action1, ('', ''))))   # SNS DisplayName, Subscriptions
+    return rows
 
 def parse_args():
     """Create arguments and populate variables from args.
@@ -133,40 +104,45 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--region', type=str, default=False,
                         help='AWS region; Use "all" for all regions')
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help='Compress output with gzip')
     return parser.parse_args()
 
 def pretty_statistic(stat):
     """Return a pretty/abbreviated version of statistic."""
-    translation = {"Average": "avg",
-                   "Maximum": "max",
-                   "Minimum": "min"}
-    try:
-        stat = translation[stat]
-    except KeyError:
-        pass
-    return stat
+    return PRETTY_STATISTICS.get(stat, stat)
 
 def pretty_operator(operator):
     """Return a pretty/abbreviated version of operator."""
-    translation = {"GreaterThanOrEqualToThreshold": ">=",
-                   "GreaterThanThreshold": ">",
-                   "LessThanOrEqualToThreshold": "<=",
-                   "LessThanThreshold": "<"}
+    return PRETTY_OPERATORS.get(operator, operator)
+
+def get_topic_info(sns_client, topic):
+    """Return DisplayName and Subscriptions of SNS topic."""
     try:
-        operator = translation[operator]
-    except KeyError:
-        pass
-    return operator
+        displayname = get_topic_name(sns_client, topic)
+        # Join proto and endpoint for each subscription ': '
+        # Then join each subscription pair comma-separated
+        subscriptions = ','.join(
+            f"{subscription['Protocol']}: {subscription['Endpoint']}"
+            for subscription in helpers.get_items(client=sns_client,
+                                                  function='list_subscriptions_by_topic',
+                                                  item_name='Subscriptions',
+                                                  TopicArn=topic))
+    except sns_client.exceptions.NotFoundException:
+        # Topic does not exist or cannot be listed
+        return '', ''
+    except sns_client.exceptions.ClientError as err:
+        if not helpers.is_throttled(err):
+            raise
+        # Still throttled after retries; Leave topic details blank rather than abandoning the region
+        helpers.report_skipped(f'Skipping topic details for {topic}: {err}')
+        return '', ''
+    return displayname, subscriptions
 
 def get_topic_name(sns_client, topic):
     """Return DisplayName of SNS topic."""
-    displayname = ''
     response = sns_client.get_topic_attributes(TopicArn=topic)
-    try:
-        displayname = response['Attributes']['DisplayName']
-    except KeyError:
-        pass # No DisplayName
-    return displayname
+    return response['Attributes'].get('DisplayName', '')
 
 if __name__ == '__main__':
     main()
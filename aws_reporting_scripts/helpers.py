@@ -7,8 +7,56 @@
 """Common functions for aws-reporting-scripts"""
 
 import sys
-import boto3
-import botocore.exceptions
+import os
+import io
+import gzip
+import json
+import time
+import atexit
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3 and botocore are slow to import, so they are imported on first use rather than here;
+# This keeps e.g. --help responsive
+# pylint: disable=import-outside-toplevel
+
+# Configuration (botocore.config.Config arguments) for all clients
+# Adaptive retry mode rate-limits requests client-side once the API throttles us, which
+# concurrent queries readily trigger; A larger connection pool lets a client issue more than
+# 10 concurrent requests
+CLIENT_CONFIG = {'retries': {'mode': 'adaptive', 'max_attempts': 10},
+                 'max_pool_connections': 50}
+
+# Cache of clients, shared by all threads
+# A boto3 session is not thread-safe, so the single shared session (see get_session) is only used
+# while holding SESSION_LOCK; Clients are thread-safe once created
+CLIENTS = {}
+SESSION_LOCK = threading.Lock()
+
+# On-disk cache of region list, and maximum age of cache in seconds
+REGION_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                'aws-reporting-scripts')
+REGION_CACHE_TTL = 86400
+
+# Error codes returned by AWS APIs when requests are throttled
+THROTTLING_ERROR_CODES = frozenset(('Throttling',
+                                    'ThrottlingException',
+                                    'ThrottledException',
+                                    'RequestLimitExceeded',
+                                    'TooManyRequestsException'))
+
+# Set when any item is skipped (e.g. still throttled after retries), so the report is incomplete
+SKIPPED = threading.Event()
+
+# Exit status when the report is incomplete
+INCOMPLETE_EXIT_CODE = 11
+
+# Write buffer size for output stream
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# gzip compression level for output stream; Low levels compress repetitive CSV well, cheaply
+OUTPUT_COMPRESS_LEVEL = 3
 
 def get_region(proposed_region):
     """Check if passed region is valid/available, or use user's default region.
@@ -24,38 +72,86 @@ def get_region(proposed_region):
     else:
         # If proposed region is False, try to establish the user's default region
         try:
-            session = boto3.session.Session()
-            region = session.region_name
+            with SESSION_LOCK:
+                region = get_session().region_name
         except:
             raise Exception('Could not establish region. Specify -r or configure AWS_CREDENTIALS')
     return region
 
-def get_items(client, function, item_name, **args):
+@functools.lru_cache(maxsize=1)
+def get_session():
+    """Return boto3 session shared by all threads, creating it on first use.
+
+    Credentials and service models are then loaded once per run; Hold SESSION_LOCK while
+    calling this and using the session"""
+    import boto3
+    return boto3.session.Session()
+
+@functools.lru_cache(maxsize=1)
+def get_client_config():
+    """Return botocore Config built from CLIENT_CONFIG, shared by all clients."""
+    import botocore.config
+    return botocore.config.Config(**CLIENT_CONFIG)
+
+def make_client(service, region=None):
+    """Return boto3 client for service in region, using CLIENT_CONFIG.
+
+    Clients are created from the shared session and reused by all threads for repeated calls
+    with the same service and region"""
+    with SESSION_LOCK:
+        if (service, region) not in CLIENTS:
+            CLIENTS[(service, region)] = get_session().client(
+                service, region_name=region, config=get_client_config())
+        return CLIENTS[(service, region)]
+
+@functools.lru_cache(maxsize=1)
+def get_account_number():
+    """Return AWS account number from STS.
+
+    The account cannot change during a run, so STS is only queried once"""
+    return make_client('sts').get_caller_identity()['Account']
+
+def is_throttled(err):
+    """Return True if botocore ClientError err was caused by API throttling."""
+    return err.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+def report_skipped(message):
+    """Warn on stderr that an item was skipped, and mark the report as incomplete."""
+    print(f'WARNING: {message}', file=sys.stderr)
+    SKIPPED.set()
+
+def get_items(client, function, item_name, page_size=None, **args):
     """Generic paginator.
 
-    Yield items in client.function(args)['item_name']
+    Yield items in client.function(args)['item_name'] using botocore's paginator for function;
+    page_size (if set) is the maximum number of items per page
     """
-    # Used because botocore is still missing many documented paginators
-    # See: https://github.com/boto/botocore/issues/1462
-    response = getattr(client, function)(**args)
-    while response:
-        for item in response[item_name]:
-            yield item
-        if 'NextToken' in response:
-            # If there are more items, re-query with returned NextToken
-            response = getattr(client, function)(NextToken=response['NextToken'], **args)
-        else:
-            response = None
+    pagination_config = {'PageSize': page_size} if page_size else {}
+    for page in client.get_paginator(function).paginate(PaginationConfig=pagination_config,
+                                                        **args):
+        yield from page[item_name]
 
+@functools.lru_cache(maxsize=1)
 def get_region_list():
-    """Return list of AWS regions."""
-    try:
-        ec2_client = boto3.client('ec2')
-    except botocore.exceptions.NoRegionError:
-        # If we fail because the user has no default region, use us-east-1
-        # This is for listing regions only
-        # Iterating resources is then performed in each region
-        ec2_client = boto3.client('ec2', region_name='us-east-1')
+    """Return tuple of AWS regions.
+
+    Use the region list cached on disk if it is fresh, otherwise query EC2 and update the cache"""
+    cache_file = get_region_cache_file()
+    region_list = read_region_cache(cache_file)
+    if region_list is None:
+        region_list = query_region_list()
+        write_region_cache(cache_file, region_list)
+    return tuple(region_list)
+
+def query_region_list():
+    """Return list of AWS regions from EC2."""
+    import botocore.exceptions
+    # If the user has no default region, use us-east-1
+    # This is for listing regions only
+    # Iterating resources is then performed in each region
+    with SESSION_LOCK:
+        default_region = get_session().region_name
+    ec2_client = make_client('ec2', default_region or 'us-east-1')
     try:
         region_list = ec2_client.describe_regions()['Regions']
     except botocore.exceptions.ClientError as err:
@@ -64,5 +160,95 @@ def get_region_list():
         # We consider this an acceptable race condition
         print('ERROR: {0}'.format(err), file=sys.stderr)
         sys.exit(10)
-    for region in region_list:
-        yield region['RegionName']
+    return [region['RegionName'] for region in region_list]
+
+def get_region_cache_file():
+    """Return path of region cache file for the current AWS profile.
+
+    Enabled regions differ between accounts, so the cache is keyed by profile name; Unlike the
+    account number this needs no API call, so STS can be queried concurrently, and unlike the
+    access key it stays the same when temporary credentials (SSO, assumed roles etc) are renewed"""
+    with SESSION_LOCK:
+        profile = get_session().profile_name
+    return os.path.join(REGION_CACHE_DIR, 'regions-{0}.json'.format(profile.replace(os.sep, '_')))
+
+def read_region_cache(cache_file):
+    """Return region list from cache_file, or None if it is missing or stale."""
+    try:
+        if time.time() - os.path.getmtime(cache_file) > REGION_CACHE_TTL:
+            return None
+        with open(cache_file, encoding='utf-8') as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return None    # Missing, unreadable or corrupt cache is simply refreshed
+
+def write_region_cache(cache_file, region_list):
+    """Write region list to cache_file, ignoring failures."""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # Write and rename, so concurrent invocations never read a partial file
+        temp_file = '{0}.{1}'.format(cache_file, os.getpid())
+        with open(temp_file, 'w', encoding='utf-8') as cache:
+            json.dump(region_list, cache)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass    # Caching is an optimisation only
+
+def run_report(args, header, collect_region, *extra):
+    """Write CSV report to stdout: header, then rows of each region selected by args.region.
+
+    collect_region(region, account_number, *extra) returns list of rows for one region; It is
+    run for all regions concurrently in worker threads, which share clients (see make_client)
+    Exit with INCOMPLETE_EXIT_CODE if any items were skipped (see report_skipped)"""
+    # Get AWS account number from STS while establishing regions
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        account_future = executor.submit(get_account_number)
+        if args.region == 'all' or args.region == 'ALL':
+            region_list = list(get_region_list())
+        else:
+            # Check valid or return default region
+            region_list = [get_region(args.region)]
+        account_number = account_future.result()
+
+    output = get_output_stream(compress=args.gzip)
+    write_rows(output, [header])
+
+    # Query regions concurrently; Write rows in region list order, so output is stable between
+    # runs and can be diffed
+    with ThreadPoolExecutor(max_workers=min(32, len(region_list))) as executor:
+        for rows in executor.map(lambda region: collect_region(region, account_number, *extra),
+                                 region_list):
+            write_rows(output, rows)
+
+    if SKIPPED.is_set():
+        print('ERROR: Some items were skipped; Output is incomplete', file=sys.stderr)
+        sys.exit(INCOMPLETE_EXIT_CODE)
+
+def get_output_stream(compress=False):
+    """Return binary stream writing to stdout through a large buffer.
+
+    Output is gzip-compressed if compress is set, or if stdout is not a terminal and the
+    AWS_REPORTING_GZIP environment variable is set
+    Stream is flushed (and compression finished) at exit"""
+    stream = sys.stdout.buffer
+    if compress or (not sys.stdout.isatty() and os.environ.get('AWS_REPORTING_GZIP')):
+        stream = gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=OUTPUT_COMPRESS_LEVEL)
+        # Exit handlers run in reverse order, so this runs after the flush registered below
+        atexit.register(stream.close)
+    stream = io.BufferedWriter(stream, buffer_size=OUTPUT_BUFFER_SIZE)
+    atexit.register(stream.flush)
+    return stream
+
+def csv_row(fields):
+    """Return fields formatted as a CSV row.
+
+    Output matches csv.writer with the default dialect and csv.QUOTE_ALL, without the overhead
+    of csv.writer's per-field dialect handling"""
+    return '"' + '","'.join('' if field is None else str(field).replace('"', '""')
+                            for field in fields) + '"\r\n'
+
+def write_rows(stream, rows):
+    """Write rows to binary stream as UTF-8 encoded CSV.
+
+    Rows are encoded together in a single call, rather than per row or per write"""
+    stream.write(''.join(map(csv_row, rows)).encode('utf-8'))
@@ -6,68 +6,62 @@
 
 """List EC2 instances, SSM agent and platform details as CSV."""
 
-import sys
 import argparse
-import csv
-import boto3
 import helpers
 
+# EC2 instance states to include
+INSTANCE_STATE_FILTER = {
+    'Name': 'instance-state-name',
+    'Values': [
+        #'pending',
+        'running',
+        #'shutting-down',
+        #'terminated',
+        'stopping',
+        'stopped',
+    ]
+}
+
+# SSM details for instances which are not managed by SSM
+NO_SSM_INFO = ('', '', '', '', '')
+
 def main():
     """Gather and write CSV data, one row per Instance.
 
-    Iterate through specified AWS regions
+    Iterate through specified AWS regions (concurrently)
     Iterate through all EC2 instances
     Query basic EC2 instance information (Name tag, EC2 platform)
     Query SSM agent version, status, platform information
     """
     args = parse_args()
-    if args.region == 'all' or args.region == 'ALL':
-        region_list = list(helpers.get_region_list())
-    else:
-        # Check valid or return default region
-        region_list = [helpers.get_region(args.region)]
-
-    output = csv.writer(sys.stdout, delimiter=',', quotechar='"',
-                        quoting=csv.QUOTE_ALL)
-
-    # Get AWS account number from STS
-    account_number = boto3.client('sts').get_caller_identity()['Account']
 
     # Header row
-    output.writerow(['Account', 'Region', 'InstanceID', 'Name', 'EC2Platform', 'SSMPingStatus',
-                     'SSMAgentVersion', 'SSMPlatformType', 'SSMPlatformName',
-                     'SSMPlatformVersion'])
+    header = ['Account', 'Region', 'InstanceID', 'Name', 'EC2Platform', 'SSMPingStatus',
+              'SSMAgentVersion', 'SSMPlatformType', 'SSMPlatformName',
+              'SSMPlatformVersion']
+    helpers.run_report(args, header, collect_region)
 
-    for region in region_list:
-        ec2_client = boto3.client('ec2', region_name=region)
-        ssm_client = boto3.client('ssm', region_name=region)
-        instance_state_filter = {
-            'Name': 'instance-state-name',
-            'Values': [
-                #'pending',
-                'running',
-                #'shutting-down',
-                #'terminated',
-                'stopping',
-                'stopped',
-            ]
-        }
-        for reservation in helpers.get_items(client=ec2_client,
-                                             function='describe_instances',
-                                             item_name='Reservations',
-                                             Filters=[instance_state_filter]):
-            for instance in reservation['Instances']:
-                instance_ssm_info = get_instance_ssm_info(ssm_client, instance['InstanceId'])
-                output.writerow([account_number,
-                                 region,
-                                 instance['InstanceId'],
-                                 get_instance_name(instance),
-                                 get_instance_platform(instance),
-                                 instance_ssm_info['ping_status'],
-                                 instance_ssm_info['agent_version'],
-                                 instance_ssm_info['platform_type'],
-                                 instance_ssm_info['platform_name'],
-                                 instance_ssm_info['platform_version']])
+def collect_region(region, account_number):
+    """Return list of CSV rows, one per Instance in region."""
+    ec2_client = helpers.make_client('ec2', region)
+    ssm_client = helpers.make_client('ssm', region)
+    # Fetch SSM details for the whole region at once, then join them to each instance
+    ssm_info = get_ssm_info(ssm_client)
+    rows = []
+    for reservation in helpers.get_items(client=ec2_client,
+                                         function='describe_instances',
+                                         item_name='Reservations',
+                                         page_size=1000,
+                                         Filters=[INSTANCE_STATE_FILTER]):
+        for instance in reservation['Instances']:
+            tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags') or []}
+            rows.append((account_number,
+                         region,
+                         instance['InstanceId'],
+                         tags.get('Name', ''),
+                         instance.get('Platform', ''),
+                         *ssm_info.get(instance['InstanceId'], NO_SSM_INFO)))
+    return rows
 
 def parse_args():
     """Create arguments and populate variables from args.
@@ -76,47 +70,27 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--region', type=str, default=False,
                         help='AWS region; Use "all" for all regions')
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help='Compress output with gzip')
     return parser.parse_args()
 
-def get_instance_name(instance):
-    """Return instance 'Name' tag value if it exists."""
-    instance_name = ''
-    try:
-        # Looping through tags seems ugly, but no better way in boto3
-        # See https://github.com/boto/boto3/issues/264
-        for tag in instance['Tags']:
-            if tag['Key'] == 'Name':
-                instance_name = tag['Value']
-    except KeyError:
-        pass    # Instance has no tags at all
-    return instance_name
-
-def get_instance_platform(instance):
-    """Return instance Platform value if it exists."""
-    instance_platform = ''
-    try:
-        instance_platform = instance['Platform']
-    except KeyError:
-        pass
-    return instance_platform
+def get_ssm_info(ssm_client):
+    """Return dict of SSM agent details for all SSM managed instances, keyed by instance ID.
 
-def get_instance_ssm_info(ssm_client, instance_id):
-    """Return SSM agent details."""
-    ping_status, agent_version, platform_type, platform_name, platform_version = '', '', '', '', ''
-    filters = {'key': 'InstanceIds', 'valueSet': [instance_id]}
-    ssm_information = (ssm_client.describe_instance_information
-                       (InstanceInformationFilterList=[filters])['InstanceInformationList'])
-    if ssm_information:
-        ping_status = ssm_information[0]['PingStatus']
-        agent_version = ssm_information[0]['AgentVersion']
-        platform_type = ssm_information[0]['PlatformType']
-        platform_name = ssm_information[0]['PlatformName']
-        platform_version = ssm_information[0]['PlatformVersion']
-    return {'ping_status': ping_status,
-            'agent_version': agent_version,
-            'platform_type': platform_type,
-            'platform_name': platform_name,
-            'platform_version': platform_version}
+    Details are tuples of (PingStatus, AgentVersion, PlatformType, PlatformName,
+    PlatformVersion); Instances which are not managed by SSM are absent from the dict.
+    """
+    ssm_info = {}
+    for information in helpers.get_items(client=ssm_client,
+                                         function='describe_instance_information',
+                                         item_name='InstanceInformationList',
+                                         page_size=50):
+        ssm_info[information['InstanceId']] = (information.get('PingStatus', ''),
+                                               information.get('AgentVersion', ''),
+                                               information.get('PlatformType', ''),
+                                               information.get('PlatformName', ''),
+                                               information.get('PlatformVersion', ''))
+    return ssm_info
 
 if __name__ == '__main__':
     main()
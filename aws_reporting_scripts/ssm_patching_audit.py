@@ -21,72 +21,80 @@ List SSM Maintenance Windows, Tasks and Patching Baseline details.
     - Approval Delay
 """
 
-import sys
 import argparse
-import csv
-import boto3
 import helpers
 
+# Include enabled Maintenance Windows only
+MW_ENABLED_FILTER = {'Key':'Enabled', 'Values':['true']}
+
 def main():
     """Gather and write CSV data, one row per Maintenance Window.
 
-    Iterate through specified AWS regions
+    Iterate through specified AWS regions (concurrently)
     Iterate through all SSM Maintenance Windows
     Query for first Maintenance Window Task
     Query for associated Task, Patch Group and Patch Baseline details
     """
     args = parse_args()
-    if args.region == 'all' or args.region == 'ALL':
-        region_list = list(helpers.get_region_list())
-    else:
-        # Check valid or return default region
-        region_list = [helpers.get_region(args.region)]
-
-    output = csv.writer(sys.stdout, delimiter=',', quotechar='"',
-                        quoting=csv.QUOTE_ALL)
 
     # Header row
-    output.writerow(['Account', 'Region', 'MW ID', 'MW Name', 'MW Schedule', 'MW TZ', 'Task 1 ID',
-                     'Patch Group', 'Task', 'Operation', 'Baseline', 'Baseline Name', 'OS',
-                     'Patch Filter (MSRC Sev)', 'Patch Filter (Class)', 'Approval Delay'])
-
-    # Get AWS account number from STS
-    account_number = boto3.client('sts').get_caller_identity()['Account']
-
-    # Iterate through regions and Maintenance Windows
-    for region in region_list:
-        ssm_client = boto3.client('ssm', region_name=region)
-        mw_enabled_filter = {'Key':'Enabled', 'Values':['true']}
-        for maint_window in helpers.get_items(client=ssm_client,
-                                              function='describe_maintenance_windows',
-                                              item_name='WindowIdentities',
-                                              Filters=[mw_enabled_filter]):
-            # Gather data
+    header = ['Account', 'Region', 'MW ID', 'MW Name', 'MW Schedule', 'MW TZ', 'Task 1 ID',
+              'Patch Group', 'Task', 'Operation', 'Baseline', 'Baseline Name', 'OS',
+              'Patch Filter (MSRC Sev)', 'Patch Filter (Class)', 'Approval Delay']
+    helpers.run_report(args, header, collect_region)
+
+def collect_region(region, account_number):
+    """Return list of CSV rows, one per Maintenance Window in region."""
+    ssm_client = helpers.make_client('ssm', region)
+    # Patch Baseline IDs keyed by Patch Group, and Patch Baseline properties keyed by ID
+    # Many windows commonly share the same Patch Groups, so query each only once
+    baseline_ids = {}
+    baselines = {}
+    rows = []
+    for maint_window in helpers.get_items(client=ssm_client,
+                                          function='describe_maintenance_windows',
+                                          item_name='WindowIdentities',
+                                          page_size=100,
+                                          Filters=[MW_ENABLED_FILTER]):
+        # Gather data
+        try:
             maint_window_info = get_maint_window_info(ssm_client, maint_window['WindowId'])
             task_1_id = get_maint_window_task_1(ssm_client, maint_window['WindowId'])
             task_info = get_task_info(ssm_client, maint_window['WindowId'], task_1_id)
             patch_tag = get_target_patch_tag(ssm_client, maint_window['WindowId'],
                                              task_info['target_id'])
-            baseline_id = get_baseline_id(ssm_client, patch_tag)
-            baseline_info = get_baseline_info(ssm_client, baseline_id)
-
-            # Output data
-            output.writerow([account_number,
-                             region,
-                             maint_window['WindowId'],
-                             maint_window_info['name'],
-                             maint_window_info['sched'],
-                             maint_window_info['time_zone'],
-                             task_1_id,
-                             patch_tag,
-                             task_info['task'],
-                             task_info['operation'],
-                             baseline_id,
-                             baseline_info['name'],
-                             baseline_info['operating_system'],
-                             baseline_info['filter_msrc_sev'],
-                             baseline_info['filter_class'],
-                             baseline_info['delay']])
+            if patch_tag not in baseline_ids:
+                baseline_ids[patch_tag] = get_baseline_id(ssm_client, patch_tag)
+            baseline_id = baseline_ids[patch_tag]
+            if baseline_id not in baselines:
+                baselines[baseline_id] = get_baseline_info(ssm_client, baseline_id)
+            baseline_info = baselines[baseline_id]
+        except ssm_client.exceptions.ClientError as err:
+            if not helpers.is_throttled(err):
+                raise
+            # Still throttled after retries; Skip this window rather than abandoning the region
+            helpers.report_skipped(
+                f"Skipping maintenance window {maint_window['WindowId']}: {err}")
+            continue
+
+        # Output data
+        rows.append((account_number,
+                     region,
+                     maint_window['WindowId'],
+                     maint_window_info['name'],
+                     maint_window_info['sched'],
+                     maint_window_info['time_zone'],
+                     task_1_id,
+                     patch_tag,
+                     task_info['task'],
+                     task_info['operation'],
+                     baseline_id,
+                     baseline_info['name'],
+                     baseline_info['operating_system'],
+                     baseline_info['filter_msrc_sev'],
+                     baseline_info['filter_class'],
+                     baseline_info['delay']))
+    return rows
 
 def parse_args():
     """Create arguments and populate variables from args.
@@ -95,19 +103,16 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--region', type=str, default=False,
                         help='AWS region; Use "all" for all regions')
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help='Compress output with gzip')
     return parser.parse_args()
 
 def get_maint_window_info(ssm_client, maint_window_id):
     """Return basic parameters of Maintenance Window."""
-    name, sched, time_zone = '', '', ''
     maint_window = ssm_client.get_maintenance_window(WindowId=maint_window_id)
-    name = maint_window['Name']
-    sched = maint_window['Schedule']
-    try:
-        time_zone = maint_window['ScheduleTimezone']
-    except KeyError:
-        pass    # ScheduleTimezone is not set
-    return {'name': name, 'sched': sched, 'time_zone': time_zone}
+    return {'name': maint_window['Name'],
+            'sched': maint_window['Schedule'],
+            'time_zone': maint_window.get('ScheduleTimezone', '')}
 
 def get_maint_window_task_1(ssm_client, maint_window_id):
     """Return ID of first Maintenance Window Task in Maintenance Window."""
@@ -129,8 +134,8 @@ def get_task_info(ssm_client, maint_window_id, task_id):
             WindowId=maint_window_id,
             WindowTaskId=task_id)
 
-        target_id = next(item for item in maint_window_task['Targets']
-                         if item['Key'] == 'WindowTargetIds')['Values'][0]
+        targets = {item['Key']: item['Values'] for item in maint_window_task['Targets']}
+        target_id = targets.get('WindowTargetIds', [''])[0]
         task = maint_window_task['TaskArn']
         try:
             operation = (maint_window_task['TaskInvocationParameters']
@@ -144,17 +149,15 @@ def get_target_patch_tag(ssm_client, maint_window_id, target_id):
     patch_tag = ''
     filters = {'Key':'WindowTargetId', 'Values':[target_id]}
     if target_id:
+        target_list = ssm_client.describe_maintenance_window_targets(
+            WindowId=maint_window_id,
+            Filters=[filters])
         try:
-            target_list = ssm_client.describe_maintenance_window_targets(
-                WindowId=maint_window_id,
-                Filters=[filters])
-        except KeyError:
-            pass    # No targets
-        try:
-            patch_tag = next(item for item in target_list['Targets'][0]['Targets']
-                             if item['Key'] == 'tag:Patch Group')['Values'][0]
+            targets = {item['Key']: item['Values']
+                       for item in target_list['Targets'][0]['Targets']}
+            patch_tag = targets['tag:Patch Group'][0]
         except (KeyError, IndexError):
-            pass    # No 'Patch Group' tag
+            pass    # No targets or no 'Patch Group' tag
     return patch_tag
 
 def get_baseline_id(ssm_client, patch_tag):
@@ -172,12 +175,11 @@ def get_baseline_info(ssm_client, baseline_id):
         baseline = ssm_client.get_patch_baseline(BaselineId=baseline_id)
         name = baseline['Name']
         operating_system = baseline['OperatingSystem']
-        patch_filters = (baseline['ApprovalRules']['PatchRules']
-                         [0]['PatchFilterGroup']['PatchFilters'])
-        filter_msrc_sev = ",".join(next(item for item in patch_filters
-                                        if item['Key'] == 'MSRC_SEVERITY')['Values'])
-        filter_class = ",".join(next(item for item in patch_filters
-                                     if item['Key'] == 'CLASSIFICATION')['Values'])
+        patch_filters = {item['Key']: item['Values']
+                         for item in (baseline['ApprovalRules']['PatchRules']
+                                      [0]['PatchFilterGroup']['PatchFilters'])}
+        filter_msrc_sev = ",".join(patch_filters.get('MSRC_SEVERITY', []))
+        filter_class = ",".join(patch_filters.get('CLASSIFICATION', []))
         delay = baseline['ApprovalRules']['PatchRules'][0]['ApproveAfterDays']
     return {'name': name,
             'operating_system': operating_system,